@@ -1,12 +1,21 @@
+import argparse
+import asyncio
+import functools
+import json
 import logging
 import os
-import re
+import threading
+from collections import namedtuple
+import google_auth_httplib2
+import httplib2
 from dotenv import load_dotenv
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.oauth2.service_account import Credentials
 from telegram import Update
 from telegram.ext import Application, CommandHandler, CallbackContext
 from datetime import datetime
+from time import monotonic
 
 # Load environment variables
 load_dotenv()
@@ -16,196 +25,367 @@ TOKEN = os.getenv('TELEGRAM_TOKEN')
 SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE")
 SPREADSHEET_ID = os.getenv("GOOGLE_SHEET_ID")
 
+# File remembering which sheets already have headers, so restarts do not probe for them again
+HEADERS_STATE_FILE = os.getenv("HEADERS_STATE_FILE", ".headers_written.json")
+
+# Webhook settings, the bot falls back to long polling when no domain is configured
+WEBHOOK_DOMAIN = os.getenv("WEBHOOK_DOMAIN")
+PORT = int(os.getenv("PORT", 8443))
+
 # Validate environment variables
-if not all([TOKEN, SERVICE_ACCOUNT_FILE, SPREADSHEET_ID]):
-    raise ValueError("Missing required environment variables")
+if not TOKEN:
+    raise ValueError("Missing required environment variable TELEGRAM_TOKEN")
+if not SERVICE_ACCOUNT_FILE:
+    raise ValueError("Missing required environment variable GOOGLE_SERVICE_ACCOUNT_FILE")
+if not SPREADSHEET_ID:
+    raise ValueError("Missing required environment variable GOOGLE_SHEET_ID")
+
+# Month names, looked up by month number so the name is only formatted once per month
+@functools.lru_cache(maxsize=12)
+def month_name(month):
+    return datetime(2000, month, 1).strftime("%B")
+
+# Get the current month, evaluated per call so a long running bot rolls over to the new month's sheet
+def get_current_month():
+    return month_name(datetime.now().month)
 
-# Get the current month
-current_month = datetime.now().strftime("%B")
+# A1 ranges used on a month sheet, only rebuilt when the month changes
+SheetRanges = namedtuple("SheetRanges", ["headers", "bet_columns", "first_column"])
+
+@functools.lru_cache(maxsize=1)
+def get_sheet_ranges(current_month):
+    return SheetRanges(f"{current_month}!A1:K1", f"{current_month}!A:B", f"{current_month}!A:A")
 
 # Logging configuration
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
-# Google Sheets setup
+# Column headers of a month sheet, and the same row as updateCells cell data
+_HEADERS = ("Date", "Match", "Amount", "Platform", "Odds", "Correct Odds", "Profit", "Win/Lose", "Outcome $", "Peso", "TXT 2% COMS")
+_HEADER_ROW = {"values": [{"userEnteredValue": {"stringValue": header}} for header in _HEADERS]}
+
+# Google Sheets setup, built once and reused (static discovery avoids fetching the discovery document)
+@functools.lru_cache(maxsize=1)
+def get_credentials():
+    return Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=["https://www.googleapis.com/auth/spreadsheets"])
+
+@functools.lru_cache(maxsize=1)
 def get_google_sheets_service():
-    credentials = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=["https://www.googleapis.com/auth/spreadsheets"])
-    return build('sheets', 'v4', credentials=credentials)
+    return build('sheets', 'v4', credentials=get_credentials(), cache_discovery=False, static_discovery=True)
+
+# httplib2 is not thread-safe, so every worker thread keeps its own authorized connection alive between requests
+_http_local = threading.local()
+
+def get_authorized_http():
+    if not hasattr(_http_local, "http"):
+        _http_local.http = google_auth_httplib2.AuthorizedHttp(get_credentials(), http=httplib2.Http(timeout=15))
+    return _http_local.http
+
+# Run a blocking googleapiclient request in a worker thread so the bot's event loop stays responsive
+async def execute(request):
+    return await asyncio.get_running_loop().run_in_executor(None, lambda: request.execute(http=get_authorized_http()))
+
+# Per-month locks: placing a row reads the sheet, computes the position and writes it, and with concurrent
+# updates two commands for the same month must not interleave or they would pick the same row
+_SHEET_LOCKS = {}
+
+def get_sheet_lock(current_month):
+    if current_month not in _SHEET_LOCKS:
+        _SHEET_LOCKS[current_month] = asyncio.Lock()
+    return _SHEET_LOCKS[current_month]
+
+# Cache of (service, sheet, sheet_id) per month so the sheet is only set up once
+_SHEET_CACHE = {}
+
+def invalidate_sheet_cache(error, current_month):
+    # Drop the cached sheet if it was deleted or renamed behind our back
+    if isinstance(error, HttpError) and error.resp.status in (400, 404):
+        _SHEET_CACHE.pop(current_month, None)
+
+def load_headers_written():
+    try:
+        with open(HEADERS_STATE_FILE) as f:
+            return set(json.load(f))
+    except (OSError, ValueError):
+        return set()
+
+# Keys are "<spreadsheet id>:<sheet id>", a deleted and recreated month sheet gets a new sheet id
+_HEADERS_WRITTEN = load_headers_written()
+
+def mark_headers_written(key):
+    _HEADERS_WRITTEN.add(key)
+    try:
+        with open(HEADERS_STATE_FILE, "w") as f:
+            json.dump(sorted(_HEADERS_WRITTEN), f)
+    except OSError as e:
+        logging.warning("Could not save headers state: %s", e)
 
 # Initialize Google Sheet
-def initialize_google_sheets():
+async def initialize_google_sheets(current_month):
+    if current_month in _SHEET_CACHE:
+        return _SHEET_CACHE[current_month]
+
     service = get_google_sheets_service()
     sheet = service.spreadsheets()
-    response = sheet.get(spreadsheetId=SPREADSHEET_ID).execute()
+    # Only the sheet ids and titles are needed, skip the rest of the spreadsheet resource
+    response = await execute(sheet.get(spreadsheetId=SPREADSHEET_ID, fields="sheets.properties(sheetId,title)"))
     sheets = response.get('sheets', [])
 
     # Check if current month sheet exists
     sheet_id = next((s['properties']['sheetId'] for s in sheets if s['properties']['title'] == current_month), None)
     if sheet_id is None:
-        requests = [{"addSheet": {"properties": {"title": current_month}}}]
-        response = sheet.batchUpdate(spreadsheetId=SPREADSHEET_ID, body={"requests": requests}).execute()
-        sheet_id = response['replies'][0]['addSheet']['properties']['sheetId']
-        logging.info(f"New sheet '{current_month}' created successfully.")
-
-    # Set headers if not already set
-    headers = ["Date", "Match", "Amount", "Platform", "Odds", "Correct Odds", "Profit", "Win/Lose", "Outcome $", "Peso", "TXT 2% COMS"]
-    range_ = f"{current_month}!A1:K1"
-    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=range_).execute()
-
-    if not result.get('values'):
-        sheet.values().update(spreadsheetId=SPREADSHEET_ID, range=range_, valueInputOption="RAW", body={'values': [headers]}).execute()
-        logging.info("Headers added.")
-
-    # Apply enhanced data validation for "Win/Lose" dropdown
-    requests = [
-        {
-            "setDataValidation": {
-                "range": {"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 1000, "startColumnIndex": 7, "endColumnIndex": 8},
-                "rule": {
-                    "condition": {"type": "ONE_OF_LIST", "values": [{"userEnteredValue": "WIN"}, {"userEnteredValue": "LOSE"}, {"userEnteredValue": "DRAW"}]},
-                    "showCustomUi": True
+        # Choose the new sheet id up front so the sheet can be created, given headers, validation and
+        # formatting in a single batchUpdate. Formatting is only applied here, re-applying it duplicates the conditional rules.
+        sheet_id = max((s['properties']['sheetId'] for s in sheets), default=0) + 1
+        requests = [
+            {"addSheet": {"properties": {"sheetId": sheet_id, "title": current_month}}},
+            {
+                "updateCells": {
+                    "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+                    "rows": [_HEADER_ROW],
+                    "fields": "userEnteredValue"
                 }
-            }
-        },
-        {
-            "repeatCell": {
-                "range": {"sheetId": sheet_id, "startRowIndex": 0, "endRowIndex": 1, "startColumnIndex": 0, "endColumnIndex": 11},
-                "cell": {
-                    "userEnteredFormat": {
-                        "backgroundColor": {"red": 1.0, "green": 0.8, "blue": 0.6},
-                        "textFormat": {"bold": True}
+            },
+            {
+                "setDataValidation": {
+                    "range": {"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 1000, "startColumnIndex": 7, "endColumnIndex": 8},
+                    "rule": {
+                        "condition": {"type": "ONE_OF_LIST", "values": [{"userEnteredValue": "WIN"}, {"userEnteredValue": "LOSE"}, {"userEnteredValue": "DRAW"}]},
+                        "showCustomUi": True
                     }
-                },
-                "fields": "userEnteredFormat(backgroundColor,textFormat)"
-            }
-        },
-        {
-            "addConditionalFormatRule": {
-                "rule": {
-                    "ranges": [{"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 1000, "startColumnIndex": 7, "endColumnIndex": 8}],
-                    "booleanRule": {
-                        "condition": {
-                            "type": "TEXT_EQ",
-                            "values": [{"userEnteredValue": "WIN"}]
-                        },
-                        "format": {
-                            "backgroundColor": {"red": 0.0, "green": 0.6, "blue": 0.0},
-                            "textFormat": {"foregroundColor": {"red": 1.0, "green": 1.0, "blue": 1.0}, "bold": True}
+                }
+            },
+            {
+                "repeatCell": {
+                    "range": {"sheetId": sheet_id, "startRowIndex": 0, "endRowIndex": 1, "startColumnIndex": 0, "endColumnIndex": 11},
+                    "cell": {
+                        "userEnteredFormat": {
+                            "backgroundColor": {"red": 1.0, "green": 0.8, "blue": 0.6},
+                            "textFormat": {"bold": True}
                         }
-                    }
-                },
-                "index": 0
-            }
-        },
-        {
-            "addConditionalFormatRule": {
-                "rule": {
-                    "ranges": [{"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 1000, "startColumnIndex": 7, "endColumnIndex": 8}],
-                    "booleanRule": {
-                        "condition": {
-                            "type": "TEXT_EQ",
-                            "values": [{"userEnteredValue": "LOSE"}]
-                        },
-                        "format": {
-                            "backgroundColor": {"red": 1.0, "green": 0.0, "blue": 0.0},
-                            "textFormat": {"foregroundColor": {"red": 1.0, "green": 1.0, "blue": 1.0}, "bold": True}
+                    },
+                    "fields": "userEnteredFormat(backgroundColor,textFormat)"
+                }
+            },
+            {
+                "addConditionalFormatRule": {
+                    "rule": {
+                        "ranges": [{"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 1000, "startColumnIndex": 7, "endColumnIndex": 8}],
+                        "booleanRule": {
+                            "condition": {
+                                "type": "TEXT_EQ",
+                                "values": [{"userEnteredValue": "WIN"}]
+                            },
+                            "format": {
+                                "backgroundColor": {"red": 0.0, "green": 0.6, "blue": 0.0},
+                                "textFormat": {"foregroundColor": {"red": 1.0, "green": 1.0, "blue": 1.0}, "bold": True}
+                            }
                         }
-                    }
-                },
-                "index": 1
-            }
-        },
-        {
-            "addConditionalFormatRule": {
-                "rule": {
-                    "ranges": [{"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 1000, "startColumnIndex": 7, "endColumnIndex": 8}],
-                    "booleanRule": {
-                        "condition": {
-                            "type": "TEXT_EQ",
-                            "values": [{"userEnteredValue": "DRAW"}]
-                        },
-                        "format": {
-                            "backgroundColor": {"red": 0.0, "green": 0.0, "blue": 1.0},
-                            "textFormat": {"foregroundColor": {"red": 1.0, "green": 1.0, "blue": 1.0}, "bold": True}
+                    },
+                    "index": 0
+                }
+            },
+            {
+                "addConditionalFormatRule": {
+                    "rule": {
+                        "ranges": [{"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 1000, "startColumnIndex": 7, "endColumnIndex": 8}],
+                        "booleanRule": {
+                            "condition": {
+                                "type": "TEXT_EQ",
+                                "values": [{"userEnteredValue": "LOSE"}]
+                            },
+                            "format": {
+                                "backgroundColor": {"red": 1.0, "green": 0.0, "blue": 0.0},
+                                "textFormat": {"foregroundColor": {"red": 1.0, "green": 1.0, "blue": 1.0}, "bold": True}
+                            }
                         }
-                    }
-                },
-                "index": 2
+                    },
+                    "index": 1
+                }
+            },
+            {
+                "addConditionalFormatRule": {
+                    "rule": {
+                        "ranges": [{"sheetId": sheet_id, "startRowIndex": 1, "endRowIndex": 1000, "startColumnIndex": 7, "endColumnIndex": 8}],
+                        "booleanRule": {
+                            "condition": {
+                                "type": "TEXT_EQ",
+                                "values": [{"userEnteredValue": "DRAW"}]
+                            },
+                            "format": {
+                                "backgroundColor": {"red": 0.0, "green": 0.0, "blue": 1.0},
+                                "textFormat": {"foregroundColor": {"red": 1.0, "green": 1.0, "blue": 1.0}, "bold": True}
+                            }
+                        }
+                    },
+                    "index": 2
+                }
             }
-        }
-    ]
+        ]
+        await execute(sheet.batchUpdate(spreadsheetId=SPREADSHEET_ID, body={"requests": requests}))
+        mark_headers_written(f"{SPREADSHEET_ID}:{sheet_id}")
+        logging.info("New sheet '%s' created successfully.", current_month)
 
-    sheet.batchUpdate(spreadsheetId=SPREADSHEET_ID, body={"requests": requests}).execute()
+    # Set headers if not already set
+    headers_key = f"{SPREADSHEET_ID}:{sheet_id}"
+    if headers_key not in _HEADERS_WRITTEN:
+        range_ = get_sheet_ranges(current_month).headers
+        result = await execute(sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=range_))
+
+        if not result.get('values'):
+            await execute(sheet.values().update(spreadsheetId=SPREADSHEET_ID, range=range_, valueInputOption="RAW", body={'values': [list(_HEADERS)]}))
+            logging.info("Headers added.")
+        mark_headers_written(headers_key)
+
+    _SHEET_CACHE[current_month] = (service, sheet, sheet_id)
     return service, sheet, sheet_id
 
-# Pre-compile regular expressions
-website_regex = re.compile(r'\b\w+\b', re.IGNORECASE)
-match_regex = re.compile(r'([a-zA-Z]+/[a-zA-Z]+)')
-time_regex = re.compile(r'\b(1h|2h|ot|ht)\b', re.IGNORECASE)
-points_regex = re.compile(r'[uo]\d+|[+-]\d+', re.IGNORECASE)
-odds_regex = re.compile(r'@(\d+(\.\d+)?)')
-amount_currency_regex = re.compile(r'@\d+(\.\d+)?\s+(\d+[kK]?\s*[A-Za-z]*)', re.IGNORECASE)
+# Bet tokens recognised by the parser
+TIME_TOKENS = {'1h', '2h', 'ot', 'ht'}
+POINTS_PREFIXES = ('u', 'o', '+', '-')
+
+# Bet commands are ASCII, isascii() keeps isdigit()/isalpha() from accepting other Unicode digits and letters
+def is_number(text):
+    return text.isascii() and text.replace('.', '', 1).isdigit()
+
+def parse_amount(text):
+    # "250" -> 250, "5k" -> 5000, anything else -> None
+    digits, multiplier = (text[:-1], 1000) if text.endswith('k') else (text, 1)
+    return int(digits) * multiplier if digits.isascii() and digits.isdigit() else None
 
 def parse_bet_details(bet_details: str):
-    details_parts = bet_details.split(" ", 1)
-    if len(details_parts) < 2:
+    # Single pass over the whitespace separated tokens of "<website> <match> [time] [points] @odds [@odds] <amount> [currency]"
+    tokens = bet_details.split()
+    if len(tokens) < 2:
         raise ValueError("Invalid bet format.")
 
-    remaining_details = details_parts[1]
-    website = website_regex.search(remaining_details).group(0)
-    match = match_regex.search(remaining_details).group(0)
-    time = time_regex.search(remaining_details)
-    points = points_regex.search(remaining_details)
-    odds = odds_regex.findall(remaining_details)
-    amount_currency_match = amount_currency_regex.search(remaining_details)
-    is_total = 'total' in remaining_details.lower()
-
-    if not match or not amount_currency_match or len(odds) < 1:
+    website = tokens[0].upper()
+    match = time = points = ""
+    amount = None
+    currency = "USD"
+    odds = []
+    is_total = False
+    after_odds = expect_currency = False
+
+    for token in tokens[1:]:
+        lowered = token.lower()
+        if 'total' in lowered:
+            is_total = True
+
+        if expect_currency:
+            expect_currency = False
+            if len(token) == 3 and token.isascii() and token.isalpha():
+                currency = token
+                continue
+
+        if lowered.startswith('@') and is_number(lowered[1:]):
+            odds.append(token[1:])
+            after_odds = True
+            continue
+
+        if after_odds and amount is None:
+            amount = parse_amount(lowered)
+            if amount is not None:
+                after_odds = False
+                expect_currency = True
+                continue
+
+        if not match and '/' in token:
+            match = token
+        elif not time and lowered in TIME_TOKENS:
+            time = token
+        elif not points and lowered.startswith(POINTS_PREFIXES) and is_number(lowered[1:]):
+            points = token
+        after_odds = False
+
+    if not match or amount is None or len(odds) < 1:
         raise ValueError("Invalid bet details.")
 
-    time = time.group(0) if time else ""
-    points = points.group(0) if points else ""
-    bet_odds = odds[0][0]
-    correct_odds = odds[1][0] if len(odds) > 1 else "0"
-    amount_currency = amount_currency_match.group(2).strip()
+    bet_odds = odds[0]
+    correct_odds = odds[1] if len(odds) > 1 else "0"
 
-    amount_str, currency = amount_currency.split(' ')[0], re.search(r'\b[A-Za-z]{3}\b', amount_currency).group(0) if re.search(r'\b[A-Za-z]{3}\b', amount_currency) else "USD"
-    amount = int(amount_str[:-1]) * 1000 if amount_str.endswith('k') else int(amount_str)
     amount = '{:,}'.format(amount)
 
     if is_total:
         website = 'N/A'
     return website, match, time.upper(), points.upper(), bet_odds, correct_odds, amount, currency.upper(), is_total
 
+# Formulas for columns G to K of a bet row (Profit, Win/Lose, Outcome $, Peso, TXT 2% COMS), None leaves the cell blank.
+# They are written per row because /end adds header rows inside the sheet, which would block an ARRAYFORMULA.
+FORMULA_TEMPLATES = (
+    '=IF(AND(H{row}="WIN", D{row}<>"TEXTODDS"), TEXT(C{row} * F{row} - C{row} * E{row}, "#,##0"), "0")',
+    None,
+    '=IF(H{row}="WIN", C{row}*E{row}, IF(H{row}="LOSE", -C{row}, 0))',
+    '=TEXT(I{row} * 60, "#,##0")',
+    '=IF(D{row}="TEXTODDS", TEXT(C{row} * 60 * 0.02, "#,##0.00"), "")',
+)
+
+# Local copy of columns A and B per month, kept in sync with the rows written by the bot.
+# Sheets does not support conditional (ETag) reads, so the copy is re-read after a while to pick up manual edits.
+# The copy also holds the sheet's grid row count, so appends know whether the target row already exists.
+# Bets are written into an inserted row, so an outdated copy can misplace a bet but never overwrite a row;
+# a failed write drops the copy so the next bet re-reads the sheet.
+_ROWS_CACHE = {}
+ROWS_CACHE_TTL = 60  # seconds
+
+async def get_bet_columns(sheet, current_month):
+    cached = _ROWS_CACHE.get(current_month)
+    if cached and monotonic() - cached[0] < ROWS_CACHE_TTL:
+        return cached[1], cached[2], cached[3]
+
+    # Only fetch the date/marker and match columns plus the grid size, in one request. Rows with data only in C:K
+    # are not counted, which is safe because bets are written into an inserted row.
+    result = await execute(sheet.get(spreadsheetId=SPREADSHEET_ID, ranges=get_sheet_ranges(current_month).bet_columns,
+                                     includeGridData=True,
+                                     fields="sheets(properties(gridProperties(rowCount)),data(rowData(values(formattedValue))))"))
+    sheet_data = result['sheets'][0]
+    grid_rows = sheet_data['properties']['gridProperties']['rowCount']
+    first_column, matches = [], []
+    for row_data in sheet_data.get('data', [{}])[0].get('rowData', []):
+        values = row_data.get('values', [])
+        first_column.append(values[0].get('formattedValue', "") if values else "")
+        matches.append(values[1].get('formattedValue', "") if len(values) > 1 else "")
+    # Drop trailing empty rows so the lists end at the last row with data
+    while first_column and not first_column[-1] and not matches[-1]:
+        first_column.pop()
+        matches.pop()
+
+    _ROWS_CACHE[current_month] = (monotonic(), first_column, matches, grid_rows)
+    return first_column, matches, grid_rows
+
 async def save_bet_to_google_sheets(website, match, odds, correct_odds, amount, user_input, is_total):
+    current_month = get_current_month()
     try:
-        service, sheet, sheet_id = initialize_google_sheets()  # Ensure the sheet exists every time
-
-        current_date = datetime.now().strftime("%Y-%m-%d")
-        row = [current_date, user_input, amount, website.upper(), odds or "", correct_odds or "", "", "", ""]
-
-        # Fetch all rows from the sheet
-        result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=f"{current_month}!A:K").execute()
-        rows = result.get('values', [])
-
-        # Find last "End of Week" marker
-        last_end_of_week_index = -1
-        for i, existing_row in enumerate(rows):
-            if existing_row and existing_row[0].lower().startswith("end of"):
-                last_end_of_week_index = i
-
-        # Check for matches after the last "End of Week" marker
-        row_position = len(rows) + 1  # Default position after the last row
-        for i in range(last_end_of_week_index + 1, len(rows)):
-            if len(rows[i]) > 1 and match in rows[i][1] and is_total:
-                row_position = i + 1  # Found a match, set position
-                break
-            elif len(rows[i]) > 1 and match in rows[i][1]:
-                row_position = i + 2
-
-        # If no similar match is found, append after the last "End of Week"
-        if row_position <= len(rows):
-            sheet.batchUpdate(spreadsheetId=SPREADSHEET_ID, body={
-                "requests": [{
+        async with get_sheet_lock(current_month):
+            service, sheet, sheet_id = await initialize_google_sheets(current_month)  # Ensure the sheet exists every time
+
+            current_date = datetime.now().strftime("%Y-%m-%d")
+            row = [current_date, user_input, amount, website, odds or "", correct_odds or ""]
+
+            first_column, matches, grid_rows = await get_bet_columns(sheet, current_month)
+            row_count = max(len(first_column), len(matches))
+
+            # Find last "End of Week" marker, scanning backwards so the search stops at the most recent one
+            last_end_of_week_index = next((i for i in range(len(first_column) - 1, -1, -1)
+                                           if first_column[i][:6].lower() == "end of"), -1)
+
+            # Check for matches after the last "End of Week" marker
+            row_position = row_count + 1  # Default position after the last row
+            for i in range(last_end_of_week_index + 1, len(matches)):
+                if match in matches[i] and is_total:
+                    row_position = i + 1  # Found a match, set position
+                    break
+                elif match in matches[i]:
+                    row_position = i + 2
+
+            # Row values are written as plain strings (RAW), columns G/I/J/K as formulas, H is left blank
+            cells = [{"userEnteredValue": {"stringValue": str(value)}} for value in row]
+            cells += [{"userEnteredValue": {"formulaValue": formula.format(row=row_position)}} if formula else {}
+                      for formula in FORMULA_TEMPLATES]
+
+            requests = []
+            if row_position <= row_count:
+                # If a similar match was found, insert a new row below it instead of appending
+                requests.append({
                     "insertRange": {
                         "range": {
                             "sheetId": sheet_id,
@@ -214,35 +394,46 @@ async def save_bet_to_google_sheets(website, match, odds, correct_odds, amount,
                         },
                         "shiftDimension": "ROWS"
                     }
-                }]
-            }).execute()
-
-        # Update the Google Sheets with the new bet
-        sheet.values().update(spreadsheetId=SPREADSHEET_ID, range=f"{current_month}!A{row_position}",
-                              valueInputOption="RAW", body={"values": [row]}).execute()
-
-        # Add formula to profit and peso column
-        profit_formula = f'=IF(AND(H{row_position}="WIN", D{row_position}<>"TEXTODDS"), TEXT(C{row_position} * F{row_position} - C{row_position} * E{row_position}, "#,##0"), "0")'
-        peso_formula = f'=TEXT(I{row_position} * 60, "#,##0")'
-        outcome_formula = f'=IF(H{row_position}="WIN", C{row_position}*E{row_position}, IF(H{row_position}="LOSE", -C{row_position}, 0))'
-        coms_formula = f'=IF(D{row_position}="TEXTODDS", TEXT(C{row_position} * 60 * 0.02, "#,##0.00"), "")'
-
+                })
+            elif row_position <= grid_rows:
+                # Appending: insert the row so nothing already there (e.g. a hand-typed total) is written over.
+                # It takes its formatting and Win/Lose validation from the pre-formatted blank row below, not the row above.
+                requests.append({
+                    "insertDimension": {
+                        "range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": row_position - 1, "endIndex": row_position},
+                        "inheritFromBefore": False
+                    }
+                })
+            else:
+                # Appending past the end of the grid: updateCells does not grow it, so add the missing rows first
+                requests.append({
+                    "appendDimension": {"sheetId": sheet_id, "dimension": "ROWS", "length": row_position - grid_rows}
+                })
+            requests.append({
+                "updateCells": {
+                    "start": {"sheetId": sheet_id, "rowIndex": row_position - 1, "columnIndex": 0},
+                    "rows": [{"values": cells}],
+                    "fields": "userEnteredValue"
+                }
+            })
 
-        sheet.values().update(spreadsheetId=SPREADSHEET_ID,range=f"{current_month}!I{row_position}",
-                            valueInputOption="USER_ENTERED", body={"values": [[outcome_formula]]}).execute()
-        sheet.values().update(spreadsheetId=SPREADSHEET_ID, range=f"{current_month}!G{row_position}",
-                              valueInputOption="USER_ENTERED", body={"values": [[profit_formula]]}).execute()
-        sheet.values().update(spreadsheetId=SPREADSHEET_ID, range=f"{current_month}!J{row_position}",
-                              valueInputOption="USER_ENTERED", body={"values": [[peso_formula]]}).execute()
-        sheet.values().update(spreadsheetId=SPREADSHEET_ID, range=f"{current_month}!K{row_position}",
-                              valueInputOption="USER_ENTERED", body={"values": [[coms_formula]]}).execute()
+            # Insert the row, write the bet and its formulas in a single round-trip
+            await execute(sheet.batchUpdate(spreadsheetId=SPREADSHEET_ID, body={"requests": requests}))
 
+            # Mirror the write in the local copy so the next bet does not need to re-read the sheet
+            first_column.extend([""] * (row_count - len(first_column)))
+            matches.extend([""] * (row_count - len(matches)))
+            first_column.insert(row_position - 1, current_date)
+            matches.insert(row_position - 1, user_input)
+            _ROWS_CACHE[current_month] = _ROWS_CACHE[current_month][:3] + (max(grid_rows + 1, row_position),)
 
-        logging.info(f"Bet saved to row {row_position}.")
+        logging.info("Bet saved to row %s.", row_position)
     except Exception as e:
-        logging.error(f"Error saving bet to Google Sheets: {e}")
+        _ROWS_CACHE.pop(current_month, None)
+        invalidate_sheet_cache(e, current_month)
+        logging.error("Error saving bet to Google Sheets: %s", e)
         raise
-    logging.info(f"Saving bet: {user_input} with amount: {amount}")
+    logging.info("Saving bet: %s with amount: %s", user_input, amount)
 
 async def start(update: Update, context: CallbackContext):
     await update.message.reply_text(
@@ -256,13 +447,12 @@ async def bet(update: Update, context: CallbackContext):
     user_input = " ".join(context.args)
     try:
         website, match, time, points, bet_odds, correct_odds, amount, currency, is_total = parse_bet_details(user_input)
-        website = context.args[0] if not is_total else 'N/A'
 
         await save_bet_to_google_sheets(website, match, bet_odds, correct_odds, amount, user_input, is_total)
         summary = (
             f"Bet saved successfully!\n\n"
             f"----Bet Summary----\n"
-            f"Website: {website.upper()}\n"
+            f"Website: {website}\n"
             f"Match: {match.upper()} {time or ''} {points or ''}\n"
             f"Odds: {bet_odds}\n"
             f"Correct Odds: {correct_odds or 'N/A'}\n"
@@ -276,84 +466,99 @@ async def bet(update: Update, context: CallbackContext):
         await update.message.reply_text("An unexpected error occurred. Please try again later.")
 
 async def end_of_week(update: Update, context: CallbackContext):
+    current_month = get_current_month()
     try:
-        service, sheet, sheet_id = initialize_google_sheets()
-        result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=f"{current_month}!A:K").execute()
-        rows = result.get('values', [])
-        row_position = len(rows) + 1
-
-        sheet.batchUpdate(spreadsheetId=SPREADSHEET_ID, body={
-            "requests": [{
-                "insertRange": {
-                    "range": {"sheetId": sheet_id, "startRowIndex": row_position - 1, "endRowIndex": row_position},
-                    "shiftDimension": "ROWS"
-                }
-            }]
-        }).execute()
-
-        sheet.values().update(spreadsheetId=SPREADSHEET_ID, range=f"{current_month}!A{row_position}",
-                              valueInputOption="RAW", body={"values": [["End of Week"]]}).execute()
-
-        color_request = {
-            "requests": [{
-                "repeatCell": {
-                    "range": {
-                        "sheetId": sheet_id,
-                        "startRowIndex": row_position - 1,
-                        "endRowIndex": row_position,
-                        "startColumnIndex": 0,
-                        "endColumnIndex": 11
-                    },
-                    "cell": {
-                        "userEnteredFormat": {
-                            "backgroundColor": {"red": 1.0, "green": 0.8, "blue": 0.8}
-                        }
-                    },
-                    "fields": "userEnteredFormat.backgroundColor"
+        async with get_sheet_lock(current_month):
+            service, sheet, sheet_id = await initialize_google_sheets(current_month)
+            # Column A ends at the last bet, marker or header row. Rows with data only in other columns (e.g. a hand-typed
+            # total under the bets) are not counted; the rows below are inserted, not written over, so they get pushed down.
+            result = await execute(sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=get_sheet_ranges(current_month).first_column))
+            rows = result.get('values', [])
+            row_position = len(rows) + 1
+
+            # Insert the marker and header rows, fill and color them in a single round-trip
+            requests = [
+                {
+                    "insertRange": {
+                        "range": {"sheetId": sheet_id, "startRowIndex": row_position - 1, "endRowIndex": row_position + 1},
+                        "shiftDimension": "ROWS"
+                    }
+                },
+                {
+                    "updateCells": {
+                        "start": {"sheetId": sheet_id, "rowIndex": row_position - 1, "columnIndex": 0},
+                        "rows": [
+                            {"values": [{"userEnteredValue": {"stringValue": "End of Week"}}]},
+                            _HEADER_ROW
+                        ],
+                        "fields": "userEnteredValue"
+                    }
+                },
+                {
+                    "repeatCell": {
+                        "range": {
+                            "sheetId": sheet_id,
+                            "startRowIndex": row_position - 1,
+                            "endRowIndex": row_position,
+                            "startColumnIndex": 0,
+                            "endColumnIndex": 11
+                        },
+                        "cell": {
+                            "userEnteredFormat": {
+                                "backgroundColor": {"red": 1.0, "green": 0.8, "blue": 0.8}
+                            }
+                        },
+                        "fields": "userEnteredFormat.backgroundColor"
+                    }
+                },
+                {
+                    "repeatCell": {
+                        "range": {
+                            "sheetId": sheet_id,
+                            "startRowIndex": row_position,
+                            "endRowIndex": row_position + 1,
+                            "startColumnIndex": 0,
+                            "endColumnIndex": 11
+                        },
+                        "cell": {
+                            "userEnteredFormat": {
+                                "backgroundColor": {"red": 1.0, "green": 0.8, "blue": 0.6},
+                                "textFormat": {"bold": True}
+                            }
+                        },
+                        "fields": "userEnteredFormat(backgroundColor,textFormat)"
+                    }
                 }
-            }]
-        }
-        sheet.batchUpdate(spreadsheetId=SPREADSHEET_ID, body=color_request).execute()
+            ]
+            await execute(sheet.batchUpdate(spreadsheetId=SPREADSHEET_ID, body={"requests": requests}))
 
-        headers = ["Date", "Match", "Amount", "Platform", "Odds", "Correct Odds", "Profit", "Win/Lose", "Outcome $", "Peso", "TXT 2% COMS"]
-        sheet.values().update(spreadsheetId=SPREADSHEET_ID, range=f"{current_month}!A{row_position + 1}",
-                              valueInputOption="RAW", body={"values": [headers]}).execute()
-
-        header_format_request = {
-            "requests": [{
-                "repeatCell": {
-                    "range": {
-                        "sheetId": sheet_id,
-                        "startRowIndex": row_position,
-                        "endRowIndex": row_position + 1,
-                        "startColumnIndex": 0,
-                        "endColumnIndex": 11
-                    },
-                    "cell": {
-                        "userEnteredFormat": {
-                            "backgroundColor": {"red": 1.0, "green": 0.8, "blue": 0.6},
-                            "textFormat": {"bold": True}
-                        }
-                    },
-                    "fields": "userEnteredFormat(backgroundColor,textFormat)"
-                }
-            }]
-        }
-        sheet.batchUpdate(spreadsheetId=SPREADSHEET_ID, body=header_format_request).execute()
+            # The marker and header rows are not mirrored locally, re-read the sheet on the next bet
+            _ROWS_CACHE.pop(current_month, None)
 
         logging.info("End of week marker and headers added successfully.")
         await update.message.reply_text("End of Week marker and headers added successfully.")
 
     except Exception as e:
-        logging.error(f"Error adding End of Week marker and headers: {e}")
+        _ROWS_CACHE.pop(current_month, None)
+        invalidate_sheet_cache(e, current_month)
+        logging.error("Error adding End of Week marker and headers: %s", e)
         await update.message.reply_text("An error occurred while adding the End of Week marker and headers.")
 
 def main():
-    application = Application.builder().token(TOKEN).build()
+    parser = argparse.ArgumentParser(description="Betting Bot")
+    parser.add_argument("--polling", action="store_true", help="use long polling instead of a webhook")
+    args = parser.parse_args()
+
+    application = Application.builder().token(TOKEN).concurrent_updates(True).build()
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("bet", bet))
     application.add_handler(CommandHandler("end", end_of_week))
-    application.run_polling()
+
+    if args.polling or not WEBHOOK_DOMAIN:
+        application.run_polling(poll_interval=0, timeout=20)
+    else:
+        application.run_webhook(listen="0.0.0.0", port=PORT, url_path=TOKEN,
+                                webhook_url=f"https://{WEBHOOK_DOMAIN}/{TOKEN}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file